@@ -1,12 +1,18 @@
 # pi_bridge.py
 # Python 3 script for Raspberry Pi 3B
 # Responsibilities:
-#  - Spawn a real shell under a pty (bash -i).
+#  - Spawn a real shell under a pty (bash --noprofile --norc -i, TERM=vt100).
 #  - Emulate a terminal using pyte (VT100) to maintain a full screen buffer (e.g., 80x24).
-#  - Mirror the shell's stdout to this console (optional) AND send periodic full-screen snapshots
+#  - Mirror the shell's stdout to this console (optional) AND send periodic screen updates
 #    to the Pico over UART using the simple framing protocol:
-#       [0x02 'S' ROWS COLS <ROWS*COLS bytes> 0x03]
-#  - Accept "KEY:ENTER" / "KEY:BACKSPACE" messages from the Pico and write them to the shell pty.
+#       [0x02 'S' ROWS COLS <ROWS*COLS bytes> 0x03]        full snapshot (keyframe)
+#       [0x02 'D' NSPANS {ROW COL LEN <LEN bytes>}* 0x03]  changed cells since the last frame
+#       [0x02 'X' ROWS COLS LEN_HI LEN_LO <LEN bytes> 0x03] run-length coded XOR against the last frame
+#    Whichever of 'D'/'X' is shorter is sent.
+#    Nothing is sent while the screen is unchanged. A full snapshot is only resent when the
+#    Pico asks for one ("SYNC", at boot or after a bad frame) or a write to it failed.
+#  - Accept "KEY:ENTER" / "KEY:BACKSPACE" / "TXT:<text>" messages from the Pico and write them
+#    to the shell pty.
 #  - Also pass through any keyboard input from stdin to the shell pty (so you can type on the Pi).
 #
 # Dependencies: pyserial, pyte
@@ -21,54 +27,281 @@
 #
 
 
-import sys, os, time, argparse, select, serial, pty, tty, termios
+import sys, os, re, time, codecs, struct, argparse, select, selectors, threading, traceback, serial, pty, tty, termios
 import pyte
 
 def open_serial(port, baud):
+    # pyserial only configures the tty; reads and writes are raw os.read/os.write on its fd
     ser = serial.Serial(port, baudrate=baud, timeout=0)
+    os.set_blocking(ser.fileno(), False)
     return ser
 
+def handle_pico_line(pty_fd, sender, line):
+    text = line.decode("ascii", "ignore").rstrip("\r")
+    if text == "SYNC":
+        sender.resync()
+    elif text == "KEY:ENTER":
+        write_all(pty_fd, b"\n")
+    elif text == "KEY:BACKSPACE":
+        write_all(pty_fd, b"\x7f")
+    elif text.startswith("TXT:"):
+        write_all(pty_fd, text[4:].encode("ascii", "ignore"))
+
+# pyte emulates a VT100; advertising exactly that keeps programs from sending colour and
+# other xterm sequences that would only be parsed and thrown away
+SHELL_TERM = "vt100"
+
 def spawn_shell():
     pid, fd = pty.fork()
     if pid == 0:
-        # Child: new shell
-        os.execvp("bash", ["bash", "-i"])
+        # Child: new shell, skipping profile/rc so no prompt themes or startup banners
+        os.environ["TERM"] = SHELL_TERM
+        os.execvp("bash", ["bash", "--noprofile", "--norc", "-i"])
     # Parent: configure raw-ish stdin
     return pid, fd
 
+# Cap on PTY bytes fed per wakeup, so a flood of output can't starve keys and frames
+PTY_DRAIN_MAX = 64 * 1024
+
+def drain(fd, poller, limit):
+    # Read whatever fd has ready, up to limit bytes. Returns (data, eof).
+    # fd stays blocking (it is shared with the PTY writes); poller, which has fd registered
+    # for POLLIN, is asked with a zero timeout before each read so none of them blocks.
+    data = bytearray()
+    while len(data) < limit:
+        if data and not poller.poll(0):
+            return data, False
+        try:
+            chunk = os.read(fd, 4096)
+        except OSError:
+            return data, True  # EIO once the shell has exited
+        if not chunk:
+            return data, True
+        data += chunk
+    return data, False
+
+def write_all(fd, data):
+    # os.write may take only part of data; keep going until all of it is written
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
 def setup_pyte(rows, cols):
     screen = pyte.Screen(cols, rows)
     stream = pyte.Stream(screen)
     return screen, stream
 
-def frame_bytes(screen):
-    # Flatten the screen into rows*cols bytes, ascii 32..126 or space
-    rows = screen.lines
-    R = screen.lines  # undocumented but pyte exposes screen.display for text
-    text_lines = screen.display  # list[str] of length rows
-    # Make sure each line is exactly screen.columns
-    rows = screen.lines
-    cols = screen.columns
-    payload = bytearray()
+STX = 0x02
+ETX = 0x03
+
+# Snapshot cadence (~20 FPS max), on the integer monotonic clock
+SEND_INTERVAL_NS = 50_000_000
+
+# Unchanged cells this close together are folded into one span (a span header costs 3 bytes).
+SPAN_MERGE_GAP = 3
+
+# XOR deltas of 7-bit ASCII never contain 0x80, so it is free to mark runs: ESC COUNT VALUE.
+RLE_ESC = 0x80
+RLE_RUN = re.compile(rb"(.)\1{3,}|\x80", re.S)  # runs of 4+ equal bytes, or a literal ESC
+
+# Printable ASCII passes through, every other byte becomes a space
+PRINTABLE = bytes(b if 32 <= b <= 126 else 0x20 for b in range(256))
+
+# Characters outside latin-1 (box drawing, CJK, ...) also become spaces
+codecs.register_error("pibridge-space", lambda e: (" " * (e.end - e.start), e.end))
+
+# The screen shape is fixed once arguments are parsed, so the per-frame functions are
+# built then as closures with rows/cols, headers and caches already bound.
+
+def make_screen_payload(rows, cols):
+    # Returns screen_payload(screen): the screen flattened into rows*cols bytes, ascii
+    # 32..126 or space. Rendered rows are cached; only rows pyte marked dirty are redone.
+    lines = [b" " * cols] * rows
+    col_range = range(cols)
+
+    def screen_payload(screen):
+        buffer = screen.buffer
+        for y in screen.dirty:
+            if y < rows:
+                line = buffer[y]
+                text = "".join(line[x].data for x in col_range)  # same text as screen.display[y]
+                lines[y] = text.ljust(cols)[:cols].encode("latin-1", "pibridge-space").translate(PRINTABLE)
+        screen.dirty.clear()
+        return b"".join(lines)
+
+    return screen_payload
+
+# Frames are packed into one persistent buffer and handed to a single write as a
+# memoryview slice, so no frame-sized buffer is allocated or copied per frame.
+
+def diff_spans(rows, cols, cur, prev):
+    # (row, start, end) spans of cells that differ between prev and cur.
+    # Returns None if the changes don't fit in a single 'D' frame.
+    spans = []
     for r in range(rows):
-        line = text_lines[r] if r < len(text_lines) else ""
-        # Replace nonprintable
-        line = "".join(ch if 32 <= ord(ch) <= 126 else " " for ch in line)
-        # Right-pad
-        if len(line) < cols:
-            line = line + (" " * (cols - len(line)))
+        base = r * cols
+        if cur[base:base + cols] == prev[base:base + cols]:
+            continue
+        c = 0
+        while c < cols:
+            if cur[base + c] == prev[base + c]:
+                c += 1
+                continue
+            start = c
+            end = c + 1
+            c += 1
+            while c < cols and c - end < SPAN_MERGE_GAP:
+                if cur[base + c] != prev[base + c]:
+                    end = c + 1
+                c += 1
+            spans.append((r, start, end))
+    if len(spans) > 255:
+        return None
+    return spans
+
+def pack_diff(frm, cols, cur, spans):
+    frm[0] = STX
+    frm[1] = ord("D")
+    frm[2] = len(spans)
+    i = 3
+    for r, start, end in spans:
+        n = end - start
+        frm[i] = r
+        frm[i + 1] = start
+        frm[i + 2] = n
+        frm[i + 3:i + 3 + n] = cur[r * cols + start:r * cols + end]
+        i += 3 + n
+    frm[i] = ETX
+    return i + 1
+
+def rle_encode(data):
+    out = bytearray()
+    pos = 0
+    for m in RLE_RUN.finditer(data):
+        out.extend(data[pos:m.start()])
+        value = data[m.start()]
+        n = m.end() - m.start()
+        while n > 0:
+            count = min(n, 255)
+            out.extend((RLE_ESC, count, value))
+            n -= count
+        pos = m.end()
+    out.extend(data[pos:])
+    return out
+
+def xor_rle(cur, prev):
+    # XOR the whole screen against prev in one go; unchanged cells become zero runs.
+    n = len(cur)
+    delta = (int.from_bytes(cur, "big") ^ int.from_bytes(prev, "big")).to_bytes(n, "big")
+    return rle_encode(delta)
+
+def pack_xor(frm, rows, cols, rle):
+    m = len(rle)
+    struct.pack_into(">BBBBH", frm, 0, STX, ord("X"), rows & 0xFF, cols & 0xFF, m)
+    frm[6:6 + m] = rle
+    frm[6 + m] = ETX
+    return m + 7
+
+def make_frame_bytes(rows, cols):
+    # Returns frame_bytes(cur, prev, keyframe=False), which encodes the screen payload cur
+    # against prev (the last screen sent), then updates prev in place.
+    # Returns None if the screen hasn't changed and this isn't a keyframe.
+    # Falls back to a full snapshot on keyframes, a fresh prev, or when the diff isn't smaller.
+    # The returned memoryview is only valid until the next call.
+    size = rows * cols
+    header = struct.pack(">BBBB", STX, ord("S"), rows & 0xFF, cols & 0xFF)
+    frame_buf = bytearray(size + 5)  # no frame is sent larger than a snapshot
+    frame_view = memoryview(frame_buf)
+
+    def frame_bytes(cur, prev, keyframe=False):
+        if not keyframe and cur == prev:
+            return None
+        best = size + 5
+        spans = rle = None
+        if not keyframe and len(prev) == size:
+            spans = diff_spans(rows, cols, cur, prev)
+            if spans is not None:
+                d_len = 4 + sum(3 + end - start for _, start, end in spans)
+                if d_len < best:
+                    best = d_len
+                else:
+                    spans = None
+            rle = xor_rle(cur, prev)
+            if len(rle) + 7 < best:
+                best = len(rle) + 7
+                spans = None
+            else:
+                rle = None
+        if spans is not None:
+            n = pack_diff(frame_buf, cols, cur, spans)
+        elif rle is not None:
+            n = pack_xor(frame_buf, rows, cols, rle)
         else:
-            line = line[:cols]
-        payload.extend(line.encode("ascii", "replace"))
-    # Build frame
-    frm = bytearray()
-    frm.append(0x02)
-    frm.extend(b"S")
-    frm.append(rows & 0xFF)
-    frm.append(cols & 0xFF)
-    frm.extend(payload)
-    frm.append(0x03)
-    return bytes(frm)
+            frame_buf[:4] = header
+            frame_buf[4:size + 4] = cur
+            frame_buf[size + 4] = ETX
+            n = size + 5
+        prev[:] = cur
+        return frame_view[:n]
+
+    return frame_bytes
+
+class SnapshotSender:
+    # Ships screen payloads to the Pico from a worker thread so the main loop never
+    # waits on the UART. Only the newest payload is kept; it is encoded against what
+    # was actually sent, so skipping a stale one can't break the 'D'/'X' diff chain.
+    def __init__(self, fd, frame_bytes):
+        self.fd = fd
+        self.frame_bytes = frame_bytes
+        self.slot = None
+        self.cond = threading.Condition()
+        self.prev = bytearray()  # screen as last sent to the Pico
+        self.keyframe = True  # send the next frame as a full snapshot, changed or not
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(fd, selectors.EVENT_WRITE)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, payload):
+        # Replace whatever hasn't been picked up yet
+        with self.cond:
+            self.slot = payload
+            self.cond.notify()
+
+    def resync(self):
+        # The Pico lost track of the screen; send it a full snapshot on the next tick
+        with self.cond:
+            self.keyframe = True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.slot is None:
+                    self.cond.wait()
+                cur, self.slot = self.slot, None
+                keyframe, self.keyframe = self.keyframe, False
+            try:
+                frm = self.frame_bytes(cur, self.prev, keyframe=keyframe)
+                if frm is None:
+                    continue  # idle screen: keep the UART quiet
+                self._write(frm)
+            except OSError:
+                # The Pico may have missed this frame; resync with a full snapshot
+                self.resync()
+            except Exception:
+                # Don't let a bug end the thread and silently freeze the Pico's screen;
+                # prev may be half-updated, so start over from a snapshot
+                traceback.print_exc()
+                self.resync()
+
+    def _write(self, view):
+        while view:
+            try:
+                n = os.write(self.fd, view)
+            except BlockingIOError:
+                self.sel.select()  # wait for the tty to drain
+                continue
+            view = view[n:]
 
 def main():
     ap = argparse.ArgumentParser()
@@ -78,9 +311,16 @@ def main():
     ap.add_argument("--cols", type=int, default=80)
     ap.add_argument("--mirror", action="store_true", help="Also print shell output locally")
     args = ap.parse_args()
+    # Rows and cols travel as single bytes in every frame header
+    for name in ("rows", "cols"):
+        if not 1 <= getattr(args, name) <= 255:
+            ap.error("--%s must be between 1 and 255" % name)
 
     ser = open_serial(args.port, args.baud)
+    ser_fd = ser.fileno()
     pid, pty_fd = spawn_shell()
+    pty_poll = select.poll()  # readiness check between drain() reads
+    pty_poll.register(pty_fd, select.POLLIN)
     screen, stream = setup_pyte(args.rows, args.cols)
 
     # Non-blocking stdin
@@ -88,52 +328,62 @@ def main():
     old_settings = termios.tcgetattr(stdin_fd)
     tty.setcbreak(stdin_fd)
 
-    last_send = 0
+    # Register once; epoll on Linux only reports the fds that are ready
+    sel = selectors.DefaultSelector()
+    sel.register(pty_fd, selectors.EVENT_READ, "pty")
+    sel.register(stdin_fd, selectors.EVENT_READ, "stdin")
+    sel.register(ser_fd, selectors.EVENT_READ, "serial")
+
+    screen_payload = make_screen_payload(args.rows, args.cols)
+    sender = SnapshotSender(ser_fd, make_frame_bytes(args.rows, args.cols))
+
+    last_send_ns = 0
+    rx = b""  # partial line from the Pico
     try:
         while True:
-            rlist, _, _ = select.select([pty_fd, stdin_fd, ser], [], [], 0.02)
+            ready = {key.data for key, _ in sel.select(timeout=0.02)}
 
-            if pty_fd in rlist:
-                try:
-                    data = os.read(pty_fd, 1024)
-                    if data:
-                        # Update emulator
-                        try:
-                            stream.feed(data.decode("utf-8", "ignore"))
-                        except Exception:
-                            # Fallback: best effort
-                            stream.feed(data.decode("latin-1", "ignore"))
-                        if args.mirror:
-                            os.write(sys.stdout.fileno(), data)
-                except OSError:
+            if "pty" in ready:
+                # Take the whole burst and feed pyte once, rather than 1 KiB per wakeup
+                data, eof = drain(pty_fd, pty_poll, PTY_DRAIN_MAX)
+                if data:
+                    # Update emulator
+                    try:
+                        stream.feed(data.decode("utf-8", "ignore"))
+                    except Exception:
+                        # Fallback: best effort
+                        stream.feed(data.decode("latin-1", "ignore"))
+                    if args.mirror:
+                        os.write(sys.stdout.fileno(), data)
+                if eof:
                     break
 
-            if stdin_fd in rlist:
+            if "stdin" in ready:
                 data = os.read(stdin_fd, 1024)
                 if data:
-                    os.write(pty_fd, data)
+                    write_all(pty_fd, data)
 
-            if ser in rlist:
+            if "serial" in ready:
                 try:
-                    line = ser.readline()
-                    if line:
-                        line = line.decode("ascii", "ignore").strip()
-                        if line == "KEY:ENTER":
-                            os.write(pty_fd, b"\n")
-                        elif line == "KEY:BACKSPACE":
-                            os.write(pty_fd, b"\x7f")
-                except Exception:
+                    rx += os.read(ser_fd, 256)
+                except OSError:
                     pass
+                lines = rx.split(b"\n")
+                rx = lines.pop()
+                if len(rx) > 256:
+                    rx = b""  # line noise, not a message
+                for line in lines:
+                    try:
+                        handle_pico_line(pty_fd, sender, line)
+                    except OSError:
+                        pass
 
-            now = time.time()
-            if now - last_send >= 0.05:  # throttle ~20 FPS max
-                frm = frame_bytes(screen)
-                try:
-                    ser.write(frm)
-                except Exception:
-                    pass
-                last_send = now
+            now_ns = time.monotonic_ns()
+            if now_ns - last_send_ns >= SEND_INTERVAL_NS:
+                sender.submit(screen_payload(screen))
+                last_send_ns = now_ns
     finally:
+        sel.close()
         termios.tcsetattr(stdin_fd, termios.TCSADRAIN, old_settings)
 
 if __name__ == "__main__":
@@ -6,9 +6,15 @@
 //  - USB Host: TinyUSB (HID keyboard). Sends ASCII and special keys to Pi over UART.
 //  - UART protocol to Pi (same as previous Python design for frames):
 //      Pi -> Pico: [0x02 'S' ROWS COLS <ROWS*COLS bytes> 0x03]
-//    where bytes are printable ASCII (space for others).
+//    where bytes are printable ASCII (space for others), and diff frames
+//      Pi -> Pico: [0x02 'D' NSPANS {ROW COL LEN <LEN bytes>}*NSPANS 0x03]
+//    that patch only the cells changed since the previous frame, and XOR frames
+//      Pi -> Pico: [0x02 'X' ROWS COLS LEN_HI LEN_LO <LEN bytes> 0x03]
+//    carrying the screen XORed with the previous one, run-length coded
+//    (0x80 COUNT VALUE = VALUE repeated COUNT times, other bytes literal).
 //  - Pico -> Pi: lines of ASCII ending with '\n':
 //      "KEY:ENTER\n", "KEY:BACKSPACE\n", or "TXT:<text>\n"
+//    and "SYNC\n" at boot or after a bad frame, asking the Pi for a full 'S' snapshot.
 //
 // Build with pico-sdk + tinyusb (host enabled).
 //
@@ -63,6 +69,8 @@
 #define TERM_ROWS 24
 #define TERM_COLS 80
 
+#define RLE_ESC 0x80
+
 // -------------------- LCD --------------------
 static inline void lcd_pulse() {
   gpio_put(LCD_E, 1); sleep_us(1);
@@ -212,6 +220,17 @@ static void btn_poll(uint pin, absolute_time_t* last, const char* line) {
 }
 
 // -------------------- UART Frame Receiver --------------------
+static absolute_time_t last_sync;
+static bool synced_once = false;
+
+// Ask the Pi for a full snapshot (it doesn't send them unprompted), at most once a second
+static void request_sync() {
+  if (synced_once && absolute_time_diff_us(last_sync, get_absolute_time()) < 1000*1000) return;
+  synced_once = true;
+  last_sync = get_absolute_time();
+  send_line("SYNC");
+}
+
 static bool read_exact(uint8_t* dst, size_t n) {
   size_t got = 0; uint64_t start = time_us_64();
   while (got < n) {
@@ -225,12 +244,40 @@ static bool read_exact(uint8_t* dst, size_t n) {
   return true;
 }
 
-static bool try_read_frame() {
-  if (!uart_is_readable(UART_ID)) return false;
-  uint8_t b = uart_getc(UART_ID);
-  if (b != 0x02) return false;
-  if (!uart_is_readable(UART_ID)) return false;
-  if (uart_getc(UART_ID) != 'S') return false;
+static void term_apply_diff(uint8_t nspans, const uint8_t* p) {
+  for (int i=0; i<nspans; ++i) {
+    int r = p[0], c = p[1], n = p[2];
+    const uint8_t* data = p + 3;
+    p += 3 + n;
+    if (r >= TERM_ROWS) continue;
+    for (int k=0; k<n && c+k<TERM_COLS; ++k) {
+      uint8_t b = data[k];
+      term_buf[r][c+k] = (b >= 32 && b <= 126) ? (char)b : ' ';
+    }
+  }
+}
+
+static void term_apply_xor(uint8_t rows, uint8_t cols, const uint8_t* rle, size_t len) {
+  size_t total = (size_t)rows * (size_t)cols, i = 0, pos = 0;
+  while (pos < len && i < total) {
+    uint8_t count = 1, value = rle[pos];
+    if (value == RLE_ESC) {
+      if (pos + 3 > len) break;
+      count = rle[pos+1]; value = rle[pos+2]; pos += 3;
+    } else {
+      pos += 1;
+    }
+    for (size_t k=i; value && k<i+count && k<total; ++k) {
+      int r = k / cols, c = k % cols;
+      if (r >= TERM_ROWS || c >= TERM_COLS) continue;
+      uint8_t x = (uint8_t)term_buf[r][c] ^ value;
+      term_buf[r][c] = (x >= 32 && x <= 126) ? (char)x : ' ';
+    }
+    i += count;
+  }
+}
+
+static bool read_snapshot() {
   uint8_t hdr[2];
   if (!read_exact(hdr,2)) return false;
   uint8_t rows = hdr[0], cols = hdr[1];
@@ -242,10 +289,61 @@ static bool try_read_frame() {
   if (!read_exact(&etx,1)) return false;
   if (etx != 0x03) return false;
   term_apply_snapshot(rows, cols, buf);
-  render();
   return true;
 }
 
+static bool read_diff() {
+  uint8_t nspans;
+  if (!read_exact(&nspans,1)) return false;
+  // Spans are buffered until ETX so a truncated frame never half-applies
+  static uint8_t buf[TERM_ROWS*TERM_COLS + 3*255];
+  size_t len = 0;
+  for (int i=0; i<nspans; ++i) {
+    if (len + 3 > sizeof(buf)) return false;
+    if (!read_exact(buf+len,3)) return false;
+    uint8_t n = buf[len+2];
+    len += 3;
+    if (len + n > sizeof(buf)) return false;
+    if (!read_exact(buf+len,n)) return false;
+    len += n;
+  }
+  uint8_t etx;
+  if (!read_exact(&etx,1)) return false;
+  if (etx != 0x03) return false;
+  term_apply_diff(nspans, buf);
+  return true;
+}
+
+static bool read_xor() {
+  uint8_t hdr[4];
+  if (!read_exact(hdr,4)) return false;
+  size_t len = ((size_t)hdr[2] << 8) | hdr[3];
+  static uint8_t buf[TERM_ROWS*TERM_COLS + 8];
+  if (len > sizeof(buf)) return false;
+  if (!read_exact(buf, len)) return false;
+  uint8_t etx;
+  if (!read_exact(&etx,1)) return false;
+  if (etx != 0x03) return false;
+  term_apply_xor(hdr[0], hdr[1], buf, len);
+  return true;
+}
+
+static bool try_read_frame() {
+  if (!uart_is_readable(UART_ID)) return false;
+  uint8_t b = uart_getc(UART_ID);
+  if (b != 0x02) return false;
+  uint8_t cmd;
+  if (!read_exact(&cmd,1)) return false;
+  bool ok;
+  if (cmd == 'S') ok = read_snapshot();
+  else if (cmd == 'D') ok = read_diff();
+  else if (cmd == 'X') ok = read_xor();
+  else return false;
+  if (ok) render();
+  else request_sync();
+  return ok;
+}
+
 // -------------------- TinyUSB HID Host --------------------
 
 // Helpers for shift detection
@@ -323,6 +421,7 @@ int main() {
   enc_init(e1); enc_init(e2);
   btn_init(BTN_V); btn_init(BTN_H);
   term_reset();
+  request_sync();
 
   // TinyUSB Host
   board_init();
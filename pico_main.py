@@ -11,9 +11,17 @@
 #   * Pi -> Pico full-screen snapshot frames:
 #       [0x02 'S' ROWS COLS <ROWS*COLS bytes> 0x03]
 #     characters are printable ASCII or spaces; ROWS/COLS up to 255 (we use up to 24x80).
+#   * Pi -> Pico diff frames, patching only the cells that changed since the previous frame:
+#       [0x02 'D' NSPANS {ROW COL LEN <LEN bytes>}*NSPANS 0x03]
+#   * Pi -> Pico XOR frames, the screen XORed with the previous one and run-length coded:
+#       [0x02 'X' ROWS COLS LEN_HI LEN_LO <LEN bytes> 0x03]
+#     in the RLE bytes, 0x80 COUNT VALUE means VALUE repeated COUNT times; others are literals.
 #   * Pico -> Pi key events, ASCII lines:
 #       b"KEY:ENTER\n" or b"KEY:BACKSPACE\n"
+#     and b"SYNC\n" at boot or after a bad frame, asking the Pi for a full 'S' snapshot.
 # - The LCD is driven in standard 4-bit mode: RS, E, D4..D7. RW is tied to GND.
+#   After the power-on wake-up, bytes are clocked out by a PIO state machine (D4..D7 must be
+#   consecutive GPIOs).
 # - Rotary encoders: one for vertical scroll, one for horizontal scroll; push buttons generate Enter/Backspace.
 #
 # Wiring (Pico side, change pins below if needed):
@@ -25,23 +33,32 @@
 #
 
 
-from machine import Pin, UART
+from machine import Pin, Timer, UART, disable_irq, enable_irq
+import micropython
+import rp2
 import utime
 
+# Encoder/button edges use hard IRQs; give their tracebacks somewhere to go
+micropython.alloc_emergency_exception_buf(100)
+
 # --------------------------- Configuration ---------------------------
 # UART
 UART_ID = 0
 UART_BAUD = 115200
 UART_TX_PIN = 0  # GP0
 UART_RX_PIN = 1  # GP1
+UART_TIMEOUT_MS = 100      # wait for the first byte of a read
+UART_TIMEOUT_CHAR_MS = 10  # max gap between bytes before a read gives up
+UART_RXBUF = 2048          # room for a whole 80x24 frame while we are busy drawing
 
-# LCD pins (4-bit mode)
+# LCD pins (4-bit mode; D4..D7 must be consecutive for the PIO driver)
 LCD_RS = 6
 LCD_E  = 7
 LCD_D4 = 10
 LCD_D5 = 11
 LCD_D6 = 12
 LCD_D7 = 13
+LCD_SM_ID = 0  # PIO state machine used for the LCD
 
 # Rotary encoders & buttons
 ENC_V_A = 14
@@ -58,26 +75,66 @@ LCD_ROWS = 2
 # Default terminal buffer size (incoming from Pi)
 TERM_ROWS = 24
 TERM_COLS = 80
+# Largest screen a snapshot may switch to; the buffer and rx_buf each take this many bytes
+TERM_MAX_CELLS = 8192
+
+# XOR frame run marker
+RLE_ESC = 0x80
 
 # Debounce timings
 BTN_DEBOUNCE_MS = 200
+BTN_CONFIRM_MS = 10  # button must still be down this long after the edge
+BTN_QUEUE_LEN = 8  # confirmed presses waiting for the main loop
+
+# Bad frames ask the Pi for a snapshot at most this often
+SYNC_RETRY_MS = 1000
 
 # --------------------------- LCD Driver ---------------------------
+# One HD44780 byte per FIFO word: bit 0 = RS, bits 1-4 = high nibble, bits 5-8 = low nibble.
+# Runs at 1 MHz so every cycle is 1 us; E is side-set, RS is a set pin, D4..D7 are out pins.
+@rp2.asm_pio(out_init=(rp2.PIO.OUT_LOW,) * 4, set_init=rp2.PIO.OUT_LOW, sideset_init=rp2.PIO.OUT_LOW,
+             out_shiftdir=rp2.PIO.SHIFT_RIGHT, fifo_join=rp2.PIO.JOIN_TX)
+def lcd_pio():
+    pull()
+    out(x, 1)
+    jmp(not_x, "cmd")
+    set(pins, 1)
+    jmp("nibbles")
+    label("cmd")
+    set(pins, 0)
+    label("nibbles")
+    out(pins, 4)        .side(1) [1]  # high nibble, E high for 2 us
+    nop()               .side(0) [1]
+    out(pins, 4)        .side(1) [1]  # low nibble
+    nop()               .side(0)
+    set(y, 31)
+    label("busy")                     # ~64 us for the controller to execute it
+    jmp(y_dec, "busy")  [1]
+
 class LCD:
     def __init__(self, rs, e, d4, d5, d6, d7, cols=16, rows=2):
         self.cols = cols
         self.rows = rows
+        # What is on the glass, and where the controller's address counter points
+        self.shadow = bytearray(b' ' * (cols * rows))
+        self.col = 0
+        self.row = 0
         self.rs = Pin(rs, Pin.OUT, value=0)
         self.e  = Pin(e,  Pin.OUT, value=0)
         self.d4 = Pin(d4, Pin.OUT, value=0)
         self.d5 = Pin(d5, Pin.OUT, value=0)
         self.d6 = Pin(d6, Pin.OUT, value=0)
         self.d7 = Pin(d7, Pin.OUT, value=0)
+        # Power-on wake-up is nibble-at-a-time, so it is bit-banged before PIO takes the pins
         utime.sleep_ms(50)
         self._write4(0x03); utime.sleep_ms(5)
         self._write4(0x03); utime.sleep_us(150)
         self._write4(0x03)
         self._write4(0x02)  # 4-bit
+        utime.sleep_us(100)
+        self.sm = rp2.StateMachine(LCD_SM_ID, lcd_pio, freq=1_000_000,
+                                   out_base=self.d4, set_base=self.rs, sideset_base=self.e)
+        self.sm.active(1)
         self.command(0x28)  # 4-bit, 2-line, 5x8 font
         self.command(0x08)  # display off
         self.clear()
@@ -98,18 +155,23 @@ class LCD:
         self._pulse()
 
     def command(self, cmd):
-        self.rs.value(0)
-        self._write4(cmd >> 4)
-        self._write4(cmd & 0x0F)
+        self.sm.put((cmd >> 4) << 1 | (cmd & 0x0F) << 5)
 
-    def write_char(self, ch):
-        self.rs.value(1)
-        b = ord(ch)
-        self._write4(b >> 4)
-        self._write4(b & 0x0F)
+    def write_byte(self, b):
+        self.sm.put(1 | (b >> 4) << 1 | (b & 0x0F) << 5)
+        if self.col < self.cols:
+            self.shadow[self.row * self.cols + self.col] = b
+        self.col += 1  # the controller auto-increments
 
     def clear(self):
         self.command(0x01)
+        for i in range(len(self.shadow)):
+            self.shadow[i] = 32
+        self.col = 0
+        self.row = 0
+        # Clear takes ~1.5 ms; let the FIFO drain so the wait covers it
+        while self.sm.tx_fifo():
+            pass
         utime.sleep_ms(2)
 
     def set_cursor(self, col, row):
@@ -117,124 +179,249 @@ class LCD:
         col = max(0, min(self.cols-1, col))
         addr = col + (0x40 * row)
         self.command(0x80 | addr)
+        self.col = col
+        self.row = row
+
+    def blit(self, line, row):
+        # Draw a bytes line on an LCD row, writing only the cells that differ from the shadow.
+        # A run of changed cells costs one cursor move; unchanged rows cost nothing.
+        # Non-printable bytes are shown as spaces.
+        base = row * self.cols
+        for c in range(min(len(line), self.cols)):
+            b = line[c]
+            if not 32 <= b <= 126:
+                b = 32
+            if b != self.shadow[base + c]:
+                if self.row != row or self.col != c:
+                    self.set_cursor(c, row)
+                self.write_byte(b)
 
     def write_str(self, s):
-        for ch in s[:self.cols]:
-            self.write_char(ch)
+        # s is bytes
+        for b in s[:self.cols]:
+            self.write_byte(b)
 
 # --------------------------- Rotary Encoder ---------------------------
+# Step for each (last << 2) | state transition: 1 = +1, 255 = -1, 0 = no change or
+# a skipped (invalid) transition. Indexed from the IRQ handler, so no tuples are built.
+QUAD_STEPS = bytes((0, 1, 255, 0,
+                    255, 0, 0, 1,
+                    1, 0, 0, 255,
+                    0, 255, 1, 0))
+
 class Encoder:
+    # The hard IRQ only decodes the edge and accumulates steps; on_step runs later via
+    # micropython.schedule, outside interrupt context, with the net steps since last time.
     def __init__(self, pin_a, pin_b, on_step):
         self.pin_a = Pin(pin_a, Pin.IN, Pin.PULL_UP)
         self.pin_b = Pin(pin_b, Pin.IN, Pin.PULL_UP)
         self.on_step = on_step
         self.last = (self.pin_a.value() << 1) | self.pin_b.value()
-        self.pin_a.irq(self._handler, Pin.IRQ_FALLING | Pin.IRQ_RISING)
-        self.pin_b.irq(self._handler, Pin.IRQ_FALLING | Pin.IRQ_RISING)
+        self.steps = 0
+        self.scheduled = False
+        self._fire_ref = self._fire  # bound once: the IRQ must not allocate
+        self.pin_a.irq(self._handler, Pin.IRQ_FALLING | Pin.IRQ_RISING, hard=True)
+        self.pin_b.irq(self._handler, Pin.IRQ_FALLING | Pin.IRQ_RISING, hard=True)
 
     def _handler(self, pin):
-        a = self.pin_a.value()
-        b = self.pin_b.value()
-        state = (a << 1) | b
-        if state == self.last:
-            return
+        state = (self.pin_a.value() << 1) | self.pin_b.value()
         # Gray code decoding (very simple, may count twice per detent)
-        if (self.last == 0b00 and state == 0b01) or \
-           (self.last == 0b01 and state == 0b11) or \
-           (self.last == 0b11 and state == 0b10) or \
-           (self.last == 0b10 and state == 0b00):
-            direction = +1
-        else:
-            direction = -1
+        d = QUAD_STEPS[(self.last << 2) | state]
         self.last = state
-        try:
-            self.on_step(direction)
-        except Exception as e:
-            pass
+        if d == 0:
+            return
+        self.steps += -1 if d == 255 else d
+        if not self.scheduled:
+            try:
+                micropython.schedule(self._fire_ref, None)
+                self.scheduled = True
+            except RuntimeError:
+                pass  # schedule queue full; the next edge retries
+
+    def _fire(self, _):
+        irq_state = disable_irq()
+        steps = self.steps
+        self.steps = 0
+        self.scheduled = False
+        enable_irq(irq_state)
+        if steps:
+            try:
+                self.on_step(steps)
+            except Exception as e:
+                pass
 
 # --------------------------- Buttons ---------------------------
+# Confirmed presses of all buttons, in order: a ring of indices into buttons
+btn_queue = bytearray(BTN_QUEUE_LEN)
+btn_head = 0  # next slot the confirm timer fills
+btn_tail = 0  # next slot poll_buttons() sends
+buttons = []
+
 class Button:
+    # The hard IRQ only timestamps a debounced press and schedules _arm, which starts a
+    # one-shot soft Timer; its callback checks the button is still held BTN_CONFIRM_MS
+    # after the edge and queues the press. Both run even while the main loop is blocked
+    # reading a frame, so a short tap isn't lost; poll_buttons() sends what is queued.
     def __init__(self, pin, on_click):
         self.pin = Pin(pin, Pin.IN, Pin.PULL_UP)
         self.on_click = on_click
+        self.index = len(buttons)
+        buttons.append(self)
         self.last_time = 0
-        self.pin.irq(self._handler, Pin.IRQ_FALLING)
+        self.pressed_at = 0
+        self.timer = Timer()
+        self._arm_ref = self._arm  # bound once: the IRQ must not allocate
+        self._confirm_ref = self._confirm
+        self.pin.irq(self._handler, Pin.IRQ_FALLING, hard=True)
 
     def _handler(self, pin):
         now = utime.ticks_ms()
         if utime.ticks_diff(now, self.last_time) < BTN_DEBOUNCE_MS:
             return
         self.last_time = now
-        utime.sleep_ms(10)
-        if self.pin.value() == 0:
-            try:
-                self.on_click()
-            except Exception as e:
-                pass
+        self.pressed_at = now
+        try:
+            micropython.schedule(self._arm_ref, None)
+        except RuntimeError:
+            pass  # schedule queue full; the press is dropped like a bounce
+
+    def _arm(self, _):
+        # Whatever of the confirm delay the schedule queue hasn't already used up
+        left = BTN_CONFIRM_MS - utime.ticks_diff(utime.ticks_ms(), self.pressed_at)
+        self.timer.init(mode=Timer.ONE_SHOT, period=max(left, 1), callback=self._confirm_ref)
+
+    def _confirm(self, _):
+        global btn_head
+        if self.pin.value() != 0:
+            return  # released already: a glitch, not a press
+        nxt = (btn_head + 1) % BTN_QUEUE_LEN
+        if nxt == btn_tail:
+            return  # queue full
+        btn_queue[btn_head] = self.index
+        btn_head = nxt
+
+def poll_buttons():
+    # Send the queued presses from the main loop, oldest first
+    global btn_tail
+    while btn_tail != btn_head:
+        button = buttons[btn_queue[btn_tail]]
+        btn_tail = (btn_tail + 1) % BTN_QUEUE_LEN
+        try:
+            button.on_click()
+        except Exception as e:
+            pass
 
 # --------------------------- Terminal Buffer + Viewport ---------------------------
 class TerminalView:
+    # The screen is one flat row-major bytearray, one byte per cell. It holds the bytes
+    # exactly as the Pi sent them; non-printables are only filtered by LCD.blit.
     def __init__(self, rows, cols):
         self.rows = rows
         self.cols = cols
-        self.buffer = [[' ']*cols for _ in range(rows)]
+        self.buffer = bytearray(b' ' * (rows * cols))
         self.v_off = 0
         self.h_off = 0
+        self.dirty = False  # viewport moved since the last render
 
     def apply_snapshot(self, rows, cols, data_bytes):
         # Resize if needed
         if rows != self.rows or cols != self.cols:
             self.rows = rows
             self.cols = cols
-            self.buffer = [[' ']*cols for _ in range(rows)]
+            self.buffer = bytearray(rows * cols)
             self.v_off = 0
             self.h_off = 0
         # Fill
-        idx = 0
-        for r in range(rows):
-            for c in range(cols):
-                ch = chr(data_bytes[idx]) if 32 <= data_bytes[idx] <= 126 else ' '
-                self.buffer[r][c] = ch
-                idx += 1
+        self.buffer[:] = data_bytes
+
+    def apply_diff(self, spans, width=16, height=2):
+        # Patch (row, col, bytes) spans in place.
+        # Returns True if any patched cell is inside the current viewport.
+        visible = False
+        for r, c, data in spans:
+            if r >= self.rows or c >= self.cols:
+                continue
+            n = min(len(data), self.cols - c)
+            start = r * self.cols + c
+            self.buffer[start:start + n] = data[:n]
+            if self.v_off <= r < self.v_off + height and c < self.h_off + width and c + n > self.h_off:
+                visible = True
+        return visible
+
+    def apply_xor(self, rle, width=16, height=2):
+        # XOR a run-length coded delta into the buffer, row-major.
+        # Returns True if any changed cell is inside the current viewport.
+        visible = False
+        buf = self.buffer
+        total = self.rows * self.cols
+        i = 0
+        pos = 0
+        while pos < len(rle) and i < total:
+            b = rle[pos]
+            if b == RLE_ESC:
+                if pos + 3 > len(rle):
+                    break  # truncated run (garbage frame); ignore the tail
+                count = rle[pos+1]
+                value = rle[pos+2]
+                pos += 3
+            else:
+                count = 1
+                value = b
+                pos += 1
+            if value:
+                for k in range(i, min(i + count, total)):
+                    buf[k] ^= value
+                    if not visible:
+                        r = k // self.cols
+                        c = k - r * self.cols
+                        visible = self.v_off <= r < self.v_off + height and self.h_off <= c < self.h_off + width
+            i += count
+        return visible
 
     def scroll_v(self, delta):
-        self.v_off = max(0, min(self.rows-1, self.v_off + delta))
+        v = max(0, min(self.rows-1, self.v_off + delta))
+        if v != self.v_off:
+            self.v_off = v
+            self.dirty = True
     def scroll_h(self, delta):
-        self.h_off = max(0, min(self.cols-1, self.h_off + delta))
+        h = max(0, min(self.cols-1, self.h_off + delta))
+        if h != self.h_off:
+            self.h_off = h
+            self.dirty = True
 
     def window_lines(self, width=16, height=2):
-        # Return two lines of width chars at (v_off, h_off)
+        # Return two width-byte slices of the buffer at (v_off, h_off)
         lines = []
         for r in range(height):
             rr = min(self.rows-1, self.v_off + r)
-            start = self.h_off
-            end = min(self.cols, start + width)
-            row = self.buffer[rr][start:end]
-            s = ''.join(row)
+            start = rr * self.cols + self.h_off
+            end = rr * self.cols + min(self.cols, self.h_off + width)
+            row = self.buffer[start:end]
             # Pad to width
-            if len(s) < width:
-                s = s + ' '*(width - len(s))
-            lines.append(s)
+            if len(row) < width:
+                row = row + b' '*(width - len(row))
+            lines.append(row)
         return lines
 
 # --------------------------- Main ---------------------------
-uart = UART(UART_ID, UART_BAUD, tx=Pin(UART_TX_PIN), rx=Pin(UART_RX_PIN))
+uart = UART(UART_ID, UART_BAUD, tx=Pin(UART_TX_PIN), rx=Pin(UART_RX_PIN),
+            timeout=UART_TIMEOUT_MS, timeout_char=UART_TIMEOUT_CHAR_MS, rxbuf=UART_RXBUF)
 
 lcd = LCD(LCD_RS, LCD_E, LCD_D4, LCD_D5, LCD_D6, LCD_D7, LCD_COLS, LCD_ROWS)
 term = TerminalView(TERM_ROWS, TERM_COLS)
 
 def render():
     lines = term.window_lines(LCD_COLS, LCD_ROWS)
-    lcd.set_cursor(0,0); lcd.write_str(lines[0])
-    lcd.set_cursor(0,1); lcd.write_str(lines[1])
+    lcd.blit(lines[0], 0)
+    lcd.blit(lines[1], 1)
 
+# Encoders only move the viewport (by the net steps since the last call);
+# the main loop does the (single) redraw
 def on_v_step(direction):
     term.scroll_v(-direction)  # invert if needed
-    render()
 
 def on_h_step(direction):
     term.scroll_h(+direction)
-    render()
 
 def on_btn_v():
     # Send Enter
@@ -251,10 +438,118 @@ btn_h = Button(BTN_H, on_btn_h)
 
 # Initial splash
 lcd.clear()
-lcd.set_cursor(0,0); lcd.write_str("Pico Term Viewer")
-lcd.set_cursor(0,1); lcd.write_str("Waiting for Pi...")
+lcd.set_cursor(0,0); lcd.write_str(b"Pico Term Viewer")
+lcd.set_cursor(0,1); lcd.write_str(b"Waiting for Pi...")
+request_sync()
 
 # Frame receiver
+# Every frame is read into this one buffer; fields are handed around as memoryviews of it.
+rx_buf = bytearray(TERM_ROWS * TERM_COLS + 8)
+rx_view = memoryview(rx_buf)
+
+def frame_limit():
+    # The Pi never sends a frame larger than a snapshot of the current screen, so a D or X
+    # frame running past this is garbage (e.g. a bogus length after a resync)
+    return term.rows * term.cols + 5
+
+def read_exact(n, off=0):
+    # Read exactly n bytes into rx_buf[off:off+n] with one blocking readinto and return a
+    # view of them; None if the Pi went quiet mid-frame (the UART timeouts bound the wait)
+    # or the bytes would not fit in rx_buf
+    if off + n > len(rx_buf):
+        return None
+    view = rx_view[off:off + n]
+    if n and uart.readinto(view) != n:
+        return None
+    return view
+
+last_sync = 0
+
+def request_sync():
+    # Ask the Pi for a full 'S' snapshot; it no longer sends them unprompted
+    global last_sync
+    now = utime.ticks_ms()
+    if last_sync and utime.ticks_diff(now, last_sync) < SYNC_RETRY_MS:
+        return
+    last_sync = now
+    uart.write(b"SYNC\n")
+
+def bad_frame():
+    # Lost sync with the stream (or never had it): what we show may be stale until a snapshot
+    request_sync()
+    return False
+
+def read_snapshot():
+    global rx_buf, rx_view
+    hdr = read_exact(2)
+    if hdr is None:
+        return bad_frame()
+    rows = hdr[0]
+    cols = hdr[1]
+    total = rows * cols
+    if total > TERM_MAX_CELLS:
+        return bad_frame()  # a stray 0x02 'S' inside some other frame, most likely
+    if total + 1 > len(rx_buf):
+        # The Pi's screen got bigger: this is the only frame allowed to grow rx_buf
+        rx_buf = bytearray(total + 8)
+        rx_view = memoryview(rx_buf)
+    data = read_exact(total)
+    if data is None:
+        return bad_frame()
+    etx = read_exact(1, total)
+    if etx is None or etx[0] != 0x03:
+        return bad_frame()
+    # Apply
+    term.apply_snapshot(rows, cols, data)
+    return True
+
+def read_diff():
+    n = read_exact(1)
+    if n is None:
+        return bad_frame()
+    spans = []
+    off = 0
+    limit = frame_limit()
+    for _ in range(n[0]):
+        hdr = read_exact(3, off)
+        if hdr is None:
+            return bad_frame()
+        r = hdr[0]
+        c = hdr[1]
+        length = hdr[2]
+        if off + 3 + length > limit:
+            return bad_frame()
+        data = read_exact(length, off + 3)
+        if data is None:
+            return bad_frame()
+        spans.append((r, c, data))
+        off += 3 + length
+    etx = read_exact(1, off)
+    if etx is None or etx[0] != 0x03:
+        return bad_frame()
+    # Apply; only worth a redraw if the viewport changed
+    return term.apply_diff(spans, LCD_COLS, LCD_ROWS)
+
+def read_xor():
+    hdr = read_exact(4)
+    if hdr is None:
+        return bad_frame()
+    rows = hdr[0]
+    cols = hdr[1]
+    length = (hdr[2] << 8) | hdr[3]
+    if length > frame_limit():
+        return bad_frame()
+    rle = read_exact(length)
+    if rle is None:
+        return bad_frame()
+    etx = read_exact(1, length)
+    if etx is None or etx[0] != 0x03:
+        return bad_frame()
+    # A delta against a different geometry is meaningless; ask for a snapshot instead
+    if rows != term.rows or cols != term.cols:
+        return bad_frame()
+    return term.apply_xor(rle, LCD_COLS, LCD_ROWS)
+
 def read_frame():
     # Look for STX
     if uart.any() == 0:
@@ -262,32 +557,22 @@ def read_frame():
     b = uart.read(1)
     if not b or b[0] != 0x02:
         return False
-    # Next byte must be 'S'
+    # Dispatch on the command byte
     cmd = uart.read(1)
-    if not cmd or cmd != b'S':
-        return False
-    hdr = uart.read(2)
-    if not hdr or len(hdr) < 2:
-        return False
-    rows = hdr[0]
-    cols = hdr[1]
-    total = rows * cols
-    data = bytearray()
-    while len(data) < total:
-        chunk = uart.read(total - len(data))
-        if chunk:
-            data.extend(chunk)
-    etx = uart.read(1)
-    if not etx or etx[0] != 0x03:
-        return False
-    # Apply
-    term.apply_snapshot(rows, cols, data)
-    return True
+    if cmd == b'S':
+        return read_snapshot()
+    if cmd == b'D':
+        return read_diff()
+    if cmd == b'X':
+        return read_xor()
+    return False
 
-last_render = utime.ticks_ms()
 while True:
-    if read_frame():
+    poll_buttons()
+    changed = read_frame()
+    # At most one render per pass, however many detents or frames came in
+    if changed or term.dirty:
+        term.dirty = False
         render()
-        last_render = utime.ticks_ms()
     # minimal idle
     utime.sleep_ms(2)